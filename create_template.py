@@ -2,79 +2,94 @@
 
 import re
 import os
+import hashlib
+import concurrent.futures
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import unicode_to_latex
 
 URL_STEM = 'http://www.newadvent.org/bible/'
 ORDINALS = {1: 'First', 2: 'Second', 3: 'Third', 4: 'Fourth', 5: 'Fifth'}
 LANGUAGE_IDS = {'latin': 3, 'english': 2, 'greek': 1}
 BOOKS = []
+MAX_WORKERS = 8
+CACHE_DIR = '.cache'
+TIMEOUT = 30
+ROMAN_THOUSANDS = ['', 'm', 'mm', 'mmm']
+ROMAN_HUNDREDS = ['', 'c', 'cc', 'ccc', 'cd', 'd', 'dc', 'dcc', 'dccc', 'cm']
+ROMAN_TENS = ['', 'x', 'xx', 'xxx', 'xl', 'l', 'lx', 'lxx', 'lxxx', 'xc']
+ROMAN_ONES = ['', 'i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii', 'ix']
+SESSION = requests.Session()
+# one keep-alive connection per download thread, so none get thrown away and reopened
+for prefix in ['http://', 'https://']:
+    SESSION.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+# the only parts of a page that ever get looked at, the rest isn't parsed
+PARSE_ONLY = SoupStrainer(['td', 'a', 'h1', 'ul', 'p'])
+# places in the latex templates where the text gets inserted
+START_LATIN_MARKER = '\\StartOfLatin\n\n'
+START_ENGLISH_MARKER = '\\StartOfEnglish\n\n'
+CHAPTER_MARKER = '\\chapter*{}\n\n'
+# the unicode characters that latexify_certain_ones swaps for latex
+CERTAIN_ONES_TABLE = str.maketrans({
+    u'\u2019': unicode_to_latex.unicode_to_latex[u'\u0027'],
+    u'\u2026': unicode_to_latex.unicode_to_latex[u'\u2026'].strip() + '\\ ',
+    u'\u2018': unicode_to_latex.unicode_to_latex[u'\u0060'],
+    u'\u00a0': '\\ ',  # unicode equivalent of latex ~
+    u'\u00f6': unicode_to_latex.unicode_to_latex[u'\u00f6'],  # o with diaresis
+    u'\u2013': unicode_to_latex.unicode_to_latex[u'\u2013'],  # en-dash
+    u'\u2014': unicode_to_latex.unicode_to_latex[u'\u2014'],  # em-dash
+})
+# the whole unicode_to_latex table, single characters go through str.translate
+UNICODE_TO_LATEX_TABLE = str.maketrans({key: value for key, value in unicode_to_latex.unicode_to_latex.items()
+                                        if len(key) == 1})
+# ...and the few multi-character keys are matched first, longest first
+UNICODE_TO_LATEX_MULTI_RE = re.compile('(' + '|'.join([re.escape(key) for key in sorted(unicode_to_latex.unicode_to_latex, key=len, reverse=True)
+                                                       if len(key) > 1]) + ')')
+
+# regular expressions used over and over again, compiled once up front
+FOOTNOTE_MARK_RE = re.compile(r'\[[0-9]+\]')
+FOOTNOTE_LEADING_MARK_RE = re.compile(r'\[[0-9]+\] ')
+VERSE_SPACE_RE = re.compile(r'([0-9]+)  ')
+NBSP_RE = re.compile('\xa0')
+DOUBLE_SPACE_RE = re.compile('  ')
+VERSE_COLOR_RE = re.compile(r'([0-9]+)~')
+VERSE_COLOR_REPLACEMENT = r'\\textcolor{benred8}{\1}~'
+DROPCAP_RE = re.compile(r'^1~([A-Za-z]{1})([A-Za-z]*) ')
 
 
 def number_to_roman(num):
-    roman = ""
-    # figure out the thousands first
-    thousands = num // 1000
-    for i in range(thousands):
-        roman = roman + "m"
-    num = num - thousands * 1000
-    # figure out the hundreds
-    hundreds = num // 100
-    if hundreds == 9:
-        roman = roman + "cm"
-    elif hundreds >= 5:
-        roman = roman + "d"
-        for i in range(hundreds - 5):
-            roman = roman + "c"
-    elif hundreds == 4:
-        roman = roman + "cd"
-    else:
-        for i in range(hundreds):
-            roman = roman + "c"
-    num = num - hundreds * 100
-    # figure out the tens
-    tens = num // 10
-    if tens == 9:
-        roman = roman + "xc"
-    elif tens >= 5:
-        roman = roman + "l"
-        for i in range(tens - 5):
-            roman = roman + "x"
-    elif tens == 4:
-        roman = roman + "xl"
-    else:
-        for i in range(tens):
-            roman = roman + "x"
-    num = num - tens * 10
-    # figure out the ones
-    if num == 9:
-        roman = roman + "ix"
-    elif num >= 5:
-        roman = roman + "v"
-        for i in range(num - 5):
-            roman = roman + "i"
-    elif num == 4:
-        roman = roman + "iv"
-    else:
-        for i in range(num):
-            roman = roman + "i"
-    return(roman)
+    "convert a number to lower case roman numerals, e.g. 14 -> xiv"
+    return(ROMAN_THOUSANDS[num // 1000] + ROMAN_HUNDREDS[num // 100 % 10] +
+           ROMAN_TENS[num // 10 % 10] + ROMAN_ONES[num % 10])
 
 
 def create_directory(dirname):
     "creates a new directory if it doesn't already exist"
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
+    os.makedirs(dirname, exist_ok=True)
 
 
-def webpage_to_soup(url):
-    "make a get request to a website, return a soup"
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, "lxml")
+def webpage_to_soup(url, session=SESSION):
+    "make a get request to a website, return a soup. pages are cached in CACHE_DIR"
+    path = os.path.join(CACHE_DIR, hashlib.sha1(url.encode('utf8')).hexdigest() + '.html')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            content = f.read()
+    else:
+        r = session.get(url, timeout=TIMEOUT)
+        r.raise_for_status()
+        content = r.content
+        create_directory(CACHE_DIR)
+        with open(path, 'wb') as f:
+            f.write(content)
+    soup = BeautifulSoup(content, "lxml", parse_only=PARSE_ONLY)
     return(soup)
 
 
+def apply_dropcap(paragraph, lines=2):
+    "make the first letter of the chapter a big one"
+    return(DROPCAP_RE.sub('\\\\lettrine[lines=' + str(lines) + ']{\\1}{\\2} ', paragraph, count=1))
+
+
 def read_in_latex_template(filename):
     "reads in a .tex file"
     with open(filename) as f:
@@ -84,8 +99,8 @@ def read_in_latex_template(filename):
 
 def write_latex_output_to_file(output, filename):
     "write the new latex document with the bilingual text to a file"
-    with open(filename + '.tex', 'w') as f:
-        f.write(output)
+    with open(filename + '.tex', 'wb') as f:
+        f.write(output.encode('utf8'))
 
 
 class Book(object):
@@ -93,8 +108,9 @@ class Book(object):
         self.start_filename = start_filename
         self.start_url = URL_STEM + self.start_filename
         self.start_soup = webpage_to_soup(self.start_url)
-        self.number_of_chapters = self.get_number_of_chapters(self.start_soup)
-        self.chapter_urls = self.get_chapter_urls()
+        chapter_links = self.start_soup.find_all('a', class_='biblechapter')
+        self.number_of_chapters = self.get_number_of_chapters(chapter_links)
+        self.chapter_urls = self.get_chapter_urls(chapter_links)
         self.title = self.get_title_of_book(self.start_soup)
         self.dirname = self.title_to_dirname(self.title)
         self.chapters = []
@@ -102,39 +118,45 @@ class Book(object):
         BOOKS.append(self)
 
     def create_chapters(self):
+        "download all the chapter pages concurrently, then build the chapters"
+        # the first chapter is the start page, which has already been fetched
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            soups = [self.start_soup] + list(executor.map(webpage_to_soup,
+                                                          self.chapter_urls['urls'][1:]))
         for i in range(self.number_of_chapters):
             self.chapters.append(Chapter(self.chapter_urls['urls'][i],
                                          self.chapter_urls['filenames'][i],
                                          i+1,
                                          self.title,
-                                         self.dirname))
+                                         self.dirname,
+                                         soup=soups[i]))
 
-    def get_number_of_chapters(self, soup):
-        "get the number of chapters in this book"
-        chapters = soup.find_all('a', class_='biblechapter')
-        return(len(chapters) + 1)
+    def get_number_of_chapters(self, chapter_links):
+        "get the number of chapters in this book, from the links to the other chapters"
+        return(len(chapter_links) + 1)
 
-    def get_chapter_urls(self):
+    def get_chapter_urls(self, chapter_links):
         "get the urls of all the chapters in this book"
-        chapter_urls = {'urls': [self.start_url], 'filenames': [self.start_filename]}
-        chapters = self.start_soup.find_all('a', class_='biblechapter')
-        chapter_urls['urls'] += list(map(lambda x: URL_STEM + x['href'][2:], chapters))
-        chapter_urls['filenames'] += list(map(lambda x: x['href'][2:], chapters))
+        filenames = [link['href'][2:] for link in chapter_links]
+        chapter_urls = {'urls': [self.start_url] + [URL_STEM + filename for filename in filenames],
+                        'filenames': [self.start_filename] + filenames}
         return(chapter_urls)
 
     def get_title_of_book(self, soup):
         "get title of this book"
         h1s = soup.find_all('h1')
-        title = re.sub('^(.*) [0-9]+$', '\\1', h1s[0].text)
+        # the heading is e.g. "1 Maccabees 1", drop the chapter number from the end
+        title, space, number = h1s[0].text.rpartition(' ')
+        if not (space and number.isdigit()):
+            title = h1s[0].text
         return(title)
 
     def title_to_dirname(self, title):
         "format a book title to a directory name, e.g. 1 Maccabees -> first_maccabees"
-        title = re.sub(' ', '_', title)
-        if re.search('^[0-9]+_', title):
-            initial_numbers = re.findall('^[0-9]*', title)
-            ord = ORDINALS[int(initial_numbers[0])]
-            title = re.sub('^[0-9]*', ord, title)
+        title = title.replace(' ', '_')
+        number, underscore, rest = title.partition('_')
+        if underscore and number.isdigit():
+            title = ORDINALS[int(number)] + '_' + rest
         title = title.lower()
         return(title)
 
@@ -152,33 +174,37 @@ class Chapter(object):
             self.soup = webpage_to_soup(self.url)
 
         self.footnotes = self.get_footnotes_from_soup()
-        self.latin_pars = self.get_text_from_soup()
-        self.english_pars = self.get_text_from_soup(language='english')
-
-    def get_text_from_soup(self, language='latin'):
-        "grabs the paragraphs for one of the three languages"
-        language_id = LANGUAGE_IDS[language]
-        paragraphs = self.soup.find_all('td', class_='bibletd' + str(language_id))
-        paragraphs = list(map(lambda x: x.text.strip(), paragraphs))
-        paragraphs = list(map(lambda x: self.fix_spacing_around_verse_numbers(x), paragraphs))
-        if self.number == 1:
-            paragraphs = self.do_dropcaps(paragraphs, lines=3)
-        else:
-            paragraphs = self.do_dropcaps(paragraphs)
-        paragraphs = list(map(lambda x: self.turn_verse_numbers_red(x), paragraphs))
-        paragraphs = list(map(lambda x: self.latexify_certain_ones(x), paragraphs))
-        paragraphs = list(map(lambda x: self.add_footnotes_to_text(x), paragraphs))
-        # paragraphs = list(map(lambda x: self.latexify_everything(x), paragraphs))
-        return(paragraphs)
+        self.footnote_bodies = [FOOTNOTE_LEADING_MARK_RE.sub('', footnote) for footnote in self.footnotes]
+        self.latin_pars, self.english_pars = self.get_text_from_soup(['latin', 'english'])
+
+    def get_text_from_soup(self, languages=('latin',)):
+        "grabs the paragraphs for any of the three languages, one list per language"
+        class_names = ['bibletd' + str(LANGUAGE_IDS[language]) for language in languages]
+        paragraphs = {class_name: [] for class_name in class_names}
+        lines = 3 if self.number == 1 else 2
+        # walk the page once for all the languages, and run each paragraph
+        # through the whole pipeline in a single pass
+        for td in self.soup.find_all('td', class_=class_names):
+            language_pars = paragraphs[[c for c in td['class'] if c in paragraphs][0]]
+            paragraph = self.fix_spacing_around_verse_numbers(td.text.strip())
+            if not language_pars:
+                # the dropcap has to go in before the verse numbers are turned red
+                paragraph = apply_dropcap(paragraph, lines=lines)
+            paragraph = self.turn_verse_numbers_red(paragraph)
+            paragraph = self.latexify_certain_ones(paragraph)
+            paragraph = self.add_footnotes_to_text(paragraph)
+            # paragraph = self.latexify_everything(paragraph)
+            language_pars.append(paragraph)
+        return([paragraphs[class_name] for class_name in class_names])
 
     def add_footnotes_to_text(self, paragraph):
-        if re.search('\[[0-9]+\]', paragraph):
-            footnotes_found = list(set(re.findall('\[[0-9]+\]', paragraph)))
-            for i in range(len(footnotes_found)):
-                footnote_number = int(re.sub('[\[\]]', '', footnotes_found[i]))
-                paragraph = re.sub('(\\' + footnotes_found[i][:-1] + '\])',
-                                   '\\\\\\\\footnote\\1{' + re.sub('\[[0-9]+\] ', '', self.footnotes[footnote_number-1]) + '}',
-                                   paragraph)
+        "replace footnote marks like [1] with latex footnotes"
+        if '[' not in paragraph:
+            # most paragraphs have no footnotes, don't bother the regex with them
+            return(paragraph)
+        paragraph = FOOTNOTE_MARK_RE.sub(lambda x: '\\footnote' + x.group(0) + '{' +
+                                         self.footnote_bodies[int(x.group(0)[1:-1])-1] + '}',
+                                         paragraph)
         return(paragraph)
 
     def get_footnotes_from_soup(self):
@@ -186,86 +212,60 @@ class Chapter(object):
         footnote_ul = self.soup.find_all('ul', class_='bibleul')
         footnotes = footnote_ul[0].find_all('p')[:-1]
         footnotes = list(map(lambda x: x.text.strip(), footnotes))
-        footnotes = list(map(lambda x: self.latexify_certain_ones(x, True), footnotes))
+        footnotes = list(map(lambda x: self.latexify_certain_ones(x), footnotes))
         return(footnotes)
 
     def fix_spacing_around_verse_numbers(self, paragraph):
         "e.g. the english text has \xa0 after verse numbers, the latin has a double space there"
-        paragraph = re.sub('([0-9]+)  ', '\\1~', paragraph)
-        paragraph = re.sub('\\xa0', '~', paragraph)
-        paragraph = re.sub('  ', ' ', paragraph)
+        paragraph = VERSE_SPACE_RE.sub('\\1~', paragraph)
+        paragraph = NBSP_RE.sub('~', paragraph)
+        paragraph = DOUBLE_SPACE_RE.sub(' ', paragraph)
         return(paragraph)
 
     def turn_verse_numbers_red(self, paragraph):
         "turn all verse numbers red"
-        paragraph = re.sub('([0-9]+)~', '\\\\\\\\textcolor{benred8}{\\1}~', paragraph)
+        paragraph = VERSE_COLOR_RE.sub(VERSE_COLOR_REPLACEMENT, paragraph)
         return(paragraph)
 
-    def do_dropcaps(self, list_of_paragraphs, lines=2):
-        "make the first letter of the chapter a big one"
-        list_of_paragraphs[0] = re.sub('^1~([A-Za-z]{1})([A-Za-z]*) ',
-                                       '\lettrine[lines=' + str(lines) + ']{\\1}{\\2} ',
-                                       list_of_paragraphs[0])
-        return(list_of_paragraphs)
-
     def latexify_everything(self, paragraph):
-        for key, value in unicode_to_latex.unicode_to_latex.items():
-            paragraph = re.sub(re.escape(key), re.escape(value), paragraph)
-        return(paragraph)
-
-    def latexify_certain_ones(self, paragraph, footnote=False):
+        "swap every character in the unicode_to_latex table for its latex"
+        # odd pieces are the multi-character keys, even pieces the text in between
+        pieces = UNICODE_TO_LATEX_MULTI_RE.split(paragraph)
+        pieces[::2] = [piece.translate(UNICODE_TO_LATEX_TABLE) for piece in pieces[::2]]
+        pieces[1::2] = [unicode_to_latex.unicode_to_latex[piece] for piece in pieces[1::2]]
+        return(''.join(pieces))
+
+    def latexify_certain_ones(self, paragraph):
         "so far: apostrophes, ellipses"
-        if footnote:
-            footnote_backslashes = '\\\\\\\\'
-        else:
-            footnote_backslashes = ''
-        ones = {
-            u'\u2019': unicode_to_latex.unicode_to_latex[u'\u0027'],
-            u'\u2026': unicode_to_latex.unicode_to_latex[u'\u2026'].strip() + '\\\\ ',
-            u'\u2018': unicode_to_latex.unicode_to_latex[u'\u0060'],
-            u'\u00a0': ' ',  # unicode equivalent of latex ~
-            u'\u00f6': unicode_to_latex.unicode_to_latex[u'\u00f6'],  # o with diaresis
-            u'\u2013': unicode_to_latex.unicode_to_latex[u'\u2013'],  # en-dash
-            u'\u2014': unicode_to_latex.unicode_to_latex[u'\u2014'],  # em-dash
-        }
-        for key, value in ones.items():
-            paragraph = re.sub(key, footnote_backslashes + '\\\\\\' + value, paragraph)
+        paragraph = paragraph.translate(CERTAIN_ONES_TABLE)
         return(paragraph)
 
     def insert_into_template(self, template):
         "insert the latin and english paragraphs into a latex template"
         separator = '\n\\pend\\pstart\n'
-        for i in range(len(self.latin_pars)):
-            template = re.sub('(\\\\StartOfLatin\\n\\n)',
-                              '\\1' + separator + self.latin_pars[-1-i],
-                              template)
-            template = re.sub('(\\\\StartOfEnglish\\n\\n)',
-                              '\\1' + separator + self.english_pars[-1-i],
-                              template)
-        template = re.sub('(\\\\StartOfLatin\\n\\n)',
-                          '\\1\\\\begin{large}\\\\begin{center}' + str(self.number) + '\end{center}\end{large}\n' ,
-                          template)
-        template = re.sub('(\\\\StartOfEnglish\\n\\n)',
-                          '\\1\\\\begin{large}\\\\begin{center}' + str(self.number) + '\end{center}\end{large}\n' ,
-                          template)
+        heading = f'\\begin{{large}}\\begin{{center}}{self.number}\\end{{center}}\\end{{large}}\n'
+        latin = heading + ''.join([separator + paragraph for paragraph in self.latin_pars])
+        english = heading + ''.join([separator + paragraph for paragraph in self.english_pars])
+        template = template.replace(START_LATIN_MARKER, START_LATIN_MARKER + latin, 1)
+        template = template.replace(START_ENGLISH_MARKER, START_ENGLISH_MARKER + english, 1)
         return(template)
 
+    def render_english_block(self):
+        "the latex for this chapter in the english-only template: heading, then paragraphs"
+        heading = (f'\\begin{{large}}\\begin{{center}}\\textsc{{Chapter {number_to_roman(self.number)}}}'
+                   f'\\end{{center}}\\end{{large}}\n')
+        return(heading + ''.join([paragraph + '\n' for paragraph in self.english_pars]))
+
     def insert_just_english_into_template(self, template):
         "insert the latin and english paragraphs into a latex template"
-        for i in range(len(self.english_pars)):
-            template = re.sub('(\\\\chapter\*\{\}\\n\\n)',
-                              '\\1' + self.english_pars[-1-i] + '\n',
-                              template)
-        template = re.sub('(\\\\chapter\*\{\}\\n\\n)',
-                          '\\1\\\\begin{large}\\\\begin{center}\\\\textsc{Chapter ' + number_to_roman(self.number) + '}\end{center}\end{large}\n',
-                          template)
+        template = template.replace(CHAPTER_MARKER, CHAPTER_MARKER + self.render_english_block(), 1)
         return(template)
 
     def soup_to_file(self):
         "save a webpage soup to file"
         create_directory(self.book_dirname)
-        with open('./' + self.book_dirname + '/' + self.filename, 'w') as f:
-            f.write(str(self.soup.encode('utf8')))
+        with open('./' + self.book_dirname + '/' + self.filename, 'wb') as f:
+            f.write(self.soup.encode('utf8'))
 
 
 if __name__ == '__main__':
@@ -277,11 +277,10 @@ if __name__ == '__main__':
     template = read_in_latex_template('BookTemplate.tex')
     template_just_english = read_in_latex_template('BookTemplate_just_english.tex')
 
-    output = template_just_english
-    for i in range(len(BOOKS[0].chapters)):
-        output = BOOKS[0].chapters[-1-i].insert_just_english_into_template(output)
+    blocks = [chapter.render_english_block() for chapter in BOOKS[0].chapters]
+    output = template_just_english.replace(CHAPTER_MARKER, CHAPTER_MARKER + ''.join(blocks), 1)
 
     # add title of book
-    output = re.sub('chapter\*\{', 'chapter*{' + BOOKS[0].title, output)
+    output = output.replace('chapter*{', 'chapter*{' + BOOKS[0].title)
 
     write_latex_output_to_file(output, BOOKS[0].dirname)
\ No newline at end of file